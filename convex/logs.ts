@@ -23,4 +23,28 @@ export const add = mutation({
     });
     
   },
-});
\ No newline at end of file
+});
+
+// Export function "addBatch" that adds many logs in a single round-trip
+export const addBatch = mutation({
+  
+  args: {
+    logs: v.array(
+      v.object({
+        type: v.string(),
+        message: v.string(),
+        sessionId: v.string(),
+        timestamp: v.number(),
+      })
+    ),
+  },
+  
+  // Insert every log from the batch inside one transaction
+  handler: async (ctx, args) => {
+    
+    for (const log of args.logs) {
+      await ctx.db.insert("logs", log);
+    }
+    
+  },
+});
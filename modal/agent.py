@@ -1,31 +1,330 @@
 
 import modal
-import subprocess
 import os
 import tempfile
+import shutil
+import collections
+import re
 import json
-import requests
+import base64
 import asyncio
+import time
+import aiohttp
+from pathlib import Path
+
+# Claude Code SDK only exists inside the Modal image: import once at load and remember a failure
+try:
+    from claude_code_sdk import query, ClaudeCodeOptions
+    _SDK_IMPORT_ERROR = None
+except ImportError as e:
+    query = ClaudeCodeOptions = None
+    _SDK_IMPORT_ERROR = e
+
+# Message and block classes key the dispatch tables directly (one dict lookup on type(obj))
+try:
+    from claude_code_sdk import (
+        SystemMessage, AssistantMessage, UserMessage, ResultMessage,
+        TextBlock, ToolUseBlock, ToolResultBlock
+    )
+    _dispatch_key = type
+except ImportError:
+    # SDKs that don't export these classes: key the same tables by class name instead
+    SystemMessage, AssistantMessage, UserMessage, ResultMessage = (
+        "SystemMessage", "AssistantMessage", "UserMessage", "ResultMessage"
+    )
+    TextBlock, ToolUseBlock, ToolResultBlock = "TextBlock", "ToolUseBlock", "ToolResultBlock"
+    _dispatch_key = lambda obj: type(obj).__name__
+
+# Same for pygit2: local git work (branch, stage, status, commit) runs in-process through libgit2
+try:
+    import pygit2
+    _PYGIT2_IMPORT_ERROR = None
+except ImportError as e:
+    pygit2 = None
+    _PYGIT2_IMPORT_ERROR = e
+
+# Use libuv-backed event loop when available (installed in the Modal image)
+try:
+    import uvloop
+    uvloop.install()
+except ImportError:
+    pass
 
 # Create Modal image with REAL Claude Code SDK
-image = modal.Image.debian_slim().pip_install([
-    "requests",           # HTTP calls to Convex
-    "claude-code-sdk",    # Official Claude Code Python SDK
-    "anyio",              # Required for Claude Code SDK async operations
-]).apt_install([
+image = modal.Image.debian_slim().apt_install([
     "git",                # Git CLI for repository operations
-    "gh",                 # GitHub CLI for PR creation
     "nodejs",             # Node.js (required by Claude Code SDK)
     "npm"                 # NPM (required by Claude Code SDK)
+]).env({
+    "NODE_OPTIONS": "--max-old-space-size=512"  # Bound Claude Code CLI memory
+}).run_commands([
+    # Base layers (rarely change): Claude Code CLI and git identity, kept below the pip layer
+    # so dependency bumps don't rebuild the Node install
+    "npm install -g @anthropic-ai/claude-code",
+    "claude --version || true",
+    # Configure git with proper credentials once, in the image instead of per container
+    "git config --global user.email claude-code@backspace.run",
+    "git config --global user.name 'Claude Code SDK Agent'"
+]).pip_install([
+    "aiohttp",            # Async HTTP calls to Convex (pooled keep-alive session)
+    "uvloop",             # Faster event loop for the async agent
+    "claude-code-sdk",    # Official Claude Code Python SDK
+    "anyio",              # Required for Claude Code SDK async operations
+    "pygit2",             # In-process git for local repo operations (no fork per command)
 ]).run_commands([
-    # Install Claude Code CLI (required by Python SDK)
-    "npm install -g @anthropic-ai/claude-code"
+    # Warm the Python imports at build time so cold starts skip it
+    "python -c 'import claude_code_sdk, anyio, aiohttp, pygit2'",
+    "python -m compileall -q $(python -c 'import claude_code_sdk, os; print(os.path.dirname(claude_code_sdk.__file__))')"
 ])
 
 # Create Modal app
 app = modal.App("tiny-backspace-v2")
 
-@app.function(
+async def sh(*args, cwd=None, quiet=False, env=None):
+    """Run a command without blocking the event loop, returns (returncode, stdout, stderr)
+
+    quiet=True discards stdout (returned as "") and only captures stderr for error logs.
+    """
+    proc = await asyncio.create_subprocess_exec(
+        *args,
+        cwd=cwd,
+        env=env,
+        stdout=asyncio.subprocess.DEVNULL if quiet else asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE,
+    )
+    out, err = await proc.communicate()
+    return proc.returncode, out.decode() if out else "", err.decode()
+
+# Max number of log records shipped to Convex in a single mutation
+LOG_BATCH_SIZE = 64
+# How long the flusher waits for more logs to coalesce before posting (seconds)
+LOG_BATCH_WINDOW = 0.05
+# Per-request timeout for Convex calls so a slow flush can't hold up the agent
+CONVEX_TIMEOUT = aiohttp.ClientTimeout(total=5)
+
+# Branch-name slug: every run of characters outside [a-z0-9] becomes one hyphen (always a valid ref)
+_SLUG_RE = re.compile(r"[^a-z0-9]+")
+
+# Owner and repo name from https://github.com/owner/repo(.git) or git@github.com:owner/repo.git
+_GH = re.compile(r"github\.com[:/]([^/]+)/([^/]+?)(?:\.git)?/?$")
+
+# Per-container caps on in-flight calls to Convex and GitHub, so concurrent runs don't burst into rate limits
+_CONVEX_SEM = asyncio.Semaphore(8)
+_GITHUB_SEM = asyncio.Semaphore(4)
+
+# GitHub REST API version pinned for PR creation
+GITHUB_API_VERSION = "2022-11-28"
+# Scratch root for clones: RAM-backed tmpfs when available (override with AGENT_TMP)
+TMP_ROOT = os.environ.get("AGENT_TMP") or ("/dev/shm" if os.path.isdir("/dev/shm") else None)
+# Free space TMP_ROOT must have before a run clones into it. tmpfs pages count against container
+# memory and concurrent runs share it, so this is headroom for what Claude's Bash writes later
+# (npm install, build output), not just for the clone; below it the run uses the disk temp dir
+TMP_ROOT_MIN_FREE = 2 * 1024 ** 3
+
+# Max changed-file lines listed in the commit message and PR body
+PR_MAX_FILES = 50
+
+def _brief(value, limit: int) -> str:
+    """Short preview of a tool payload, slicing strings before anything is copied or serialized"""
+    if isinstance(value, str):
+        return value[:limit]
+    return json.dumps(value, default=str)[:limit]
+
+# Per-tool log formatters for ToolUseBlocks: tool input -> (log type, message)
+TOOL_LOGGERS = {
+    "Read": lambda i: ("claude_tool_read", f"Reading file: {i.get('file_path', '')}"),
+    "Write": lambda i: ("claude_tool_write", f"Writing file: {i.get('file_path', '')}"),
+    "Bash": lambda i: ("claude_tool_bash", f"Running: {_brief(i.get('command', ''), 100)}"),
+    "LS": lambda i: ("claude_tool_ls", f"Listing: {i.get('path', '')}"),
+}
+
+# Tools whose results mean new file contents are on disk and can be staged early
+STAGE_AFTER_TOOLS = {"Write"}
+
+def _handle_text_block(block, log_to_convex, state):
+    text = getattr(block, 'text', '')
+    # Only the latest text is kept, as a summary fallback when there is no result text
+    state["last_text"] = text
+    log_to_convex("claude_response", f"Claude: {text[:100]}")
+
+def _handle_tool_use_block(block, log_to_convex, state):
+    tool_name = getattr(block, 'name', 'unknown')
+    if tool_name in STAGE_AFTER_TOOLS:
+        state["pending_writes"].add(getattr(block, 'id', None))
+    formatter = TOOL_LOGGERS.get(tool_name)
+    tool_input = getattr(block, 'input', None) or {}
+    if formatter:
+        log_to_convex(*formatter(tool_input))
+    else:
+        # Only preview the first few keys; Write-style inputs can carry whole files
+        brief = ",".join(f"{k}={_brief(v, 40)}" for k, v in list(tool_input.items())[:3])
+        log_to_convex("claude_tool", f"Tool: {tool_name} - {brief}")
+
+def _handle_tool_result_block(block, log_to_convex, state):
+    # The write has landed on disk, wake the background stager
+    if getattr(block, 'tool_use_id', None) in state["pending_writes"]:
+        state["pending_writes"].discard(block.tool_use_id)
+        state["stage_needed"].set()
+    log_to_convex("claude_tool_result", f"Result: {_brief(getattr(block, 'content', None) or '', 200)}")
+
+# Content block handlers, keyed by SDK class
+BLOCK_HANDLERS = {
+    TextBlock: _handle_text_block,
+    ToolUseBlock: _handle_tool_use_block,
+    ToolResultBlock: _handle_tool_result_block,
+}
+
+def _handle_system(message, log_to_convex, state):
+    data = getattr(message, 'data', None) or {}
+    if data.get('subtype') == 'init':
+        tools = data.get('tools', [])
+        log_to_convex("claude_init", f"Claude Code initialized with {len(tools)} tools")
+
+def _handle_content(message, log_to_convex, state):
+    content = getattr(message, 'content', ())
+    if isinstance(content, str):
+        return
+    for content_block in content:
+        handler = BLOCK_HANDLERS.get(_dispatch_key(content_block))
+        if handler:
+            handler(content_block, log_to_convex, state)
+
+def _handle_result(message, log_to_convex, state):
+    # Keep Claude's final summary so it can go into the commit and PR
+    state["result_text"] = getattr(message, 'result', None)
+    if hasattr(message, 'num_turns'):
+        log_to_convex("claude_result", f"Completed with {message.num_turns} turns")
+    if hasattr(message, 'total_cost_usd'):
+        state["total_cost"] = message.total_cost_usd
+        log_to_convex("claude_cost", f"Cost: ${state['total_cost']:.4f}")
+
+# Claude Code SDK message handlers, keyed by SDK class (one dict lookup per message)
+MESSAGE_HANDLERS = {
+    SystemMessage: _handle_system,
+    AssistantMessage: _handle_content,
+    UserMessage: _handle_content,  # Carries tool results back to Claude
+    ResultMessage: _handle_result,
+}
+
+def _github_auth_env(token: str) -> dict:
+    """Env that makes git send the token as an HTTP header to github.com
+
+    Acts as a per-command credential helper: the token never lands in .git/config,
+    a credential store or the command line. Only git gets this env, Claude runs with
+    os.environ, which Agent.setup has already stripped of GITHUB_TOKEN.
+    """
+    basic = base64.b64encode(f"x-access-token:{token}".encode()).decode()
+    return {
+        **os.environ,
+        "GIT_CONFIG_COUNT": "1",
+        "GIT_CONFIG_KEY_0": "http.https://github.com/.extraheader",
+        "GIT_CONFIG_VALUE_0": f"AUTHORIZATION: basic {basic}",
+        "GIT_TERMINAL_PROMPT": "0"
+    }
+
+def _prepare_branch(repo_path: str, branch_name: str) -> str:
+    """Switch to a new branch off the cloned one, returns the cloned (base) branch name"""
+    repo = pygit2.Repository(repo_path)
+    base_branch = repo.head.shorthand
+    repo.checkout(repo.branches.local.create(branch_name, repo.head.peel(pygit2.Commit)))
+    return base_branch
+
+def _stage_all(repo_path: str) -> list:
+    """In-process `git add -A`, returns porcelain-style lines for every staged change"""
+    FileStatus = pygit2.enums.FileStatus
+    repo = pygit2.Repository(repo_path)
+    index = repo.index
+    index.add_all()
+    lines = []
+    for path, flags in sorted(repo.status().items()):
+        if flags & FileStatus.WT_DELETED:
+            # add_all only picks up new and modified files, deletions are staged explicitly
+            index.remove(path)
+            lines.append(f"D  {path}")
+        elif flags & FileStatus.INDEX_NEW:
+            lines.append(f"A  {path}")
+        elif flags & (FileStatus.INDEX_MODIFIED | FileStatus.INDEX_TYPECHANGE):
+            lines.append(f"M  {path}")
+        elif flags & FileStatus.INDEX_DELETED:
+            lines.append(f"D  {path}")
+    index.write()
+    return lines
+
+def _commit(repo_path: str, message: str):
+    """Commit the current index on HEAD (an unchanged tree makes an empty commit)"""
+    repo = pygit2.Repository(repo_path)
+    signature = repo.default_signature  # From the global git config baked into the image
+    return repo.create_commit(
+        "HEAD", signature, signature, message, repo.index.write_tree(), [repo.head.target]
+    )
+
+async def _stage_writes(stage_needed: asyncio.Event, finished: asyncio.Event, repo_path: str,
+                        index_path: str, log_to_convex):
+    """Background task that stages files as Claude writes them, so the final commit has little left to hash
+
+    Stages into a private index at index_path, never .git/index: Claude's Bash tool works in the same
+    repo, and its `git diff`, `git checkout -- <file>` and index.lock must not see our staging.
+    """
+    loop = asyncio.get_running_loop()
+    # GIT_INDEX_FILE is set on the git child only, so concurrent runs and Claude's process never see it
+    stage_env = {**os.environ, "GIT_INDEX_FILE": index_path}
+    while True:
+        await stage_needed.wait()
+        stage_needed.clear()
+        if finished.is_set():
+            return
+        try:
+            if not os.path.exists(index_path):
+                # Seed from the checkout's index so its stat cache spares rehashing untouched files
+                await loop.run_in_executor(None, shutil.copyfile, f"{repo_path}/.git/index", index_path)
+        except OSError as copy_error:
+            log_to_convex("git_stage_skipped", f"Early staging skipped: {copy_error}")
+            continue
+        add_code, _, add_err = await sh("git", "add", "-A", cwd=repo_path, quiet=True, env=stage_env)
+        if add_code != 0:
+            # The final _stage_all stages everything anyway, so a failed pass is only a lost head start
+            log_to_convex("git_stage_skipped", f"Early staging skipped: {add_err.strip()}")
+
+def _apply_staged_index(repo_path: str, index_path: str):
+    """Swap the stager's private index in as .git/index once Claude is done (no-op if it never ran)"""
+    if os.path.exists(index_path):
+        os.replace(index_path, f"{repo_path}/.git/index")
+
+async def _with_github_slot(coro):
+    """Await a GitHub-bound call while holding one of the container's GitHub slots"""
+    async with _GITHUB_SEM:
+        return await coro
+
+async def _post_logs(http, convex_url: str, batch: list):
+    """Send a batch of log records to Convex in one request"""
+    try:
+        async with _CONVEX_SEM, http.post(f"{convex_url}/api/mutation",
+            json={
+                "path": "logs:addBatch",
+                "args": {"logs": batch}
+            },
+            timeout=CONVEX_TIMEOUT
+        ) as response:
+            print(f"[convex] Flushed {len(batch)} logs (Convex: {response.status})")
+    except Exception as e:
+        print(f"[convex] Failed to flush {len(batch)} logs (Convex failed: {e})")
+
+async def _flush_logs(queue: asyncio.Queue, http, convex_url: str):
+    """Background task that drains the log queue and posts records to Convex in batches"""
+    while True:
+        batch = [await queue.get()]
+        if queue.empty():
+            # Give the agent a moment to produce more logs before paying for a round-trip
+            await asyncio.sleep(LOG_BATCH_WINDOW)
+        while len(batch) < LOG_BATCH_SIZE and not queue.empty():
+            batch.append(queue.get_nowait())
+        try:
+            await _post_logs(http, convex_url, batch)
+        finally:
+            for _ in batch:
+                queue.task_done()
+
+@app.cls(
     image=image,
     # Secrets needed for Claude Code SDK
     secrets=[
@@ -33,85 +332,141 @@ app = modal.App("tiny-backspace-v2")
         modal.Secret.from_name("github-token"),        # GitHub Personal Access Token
         modal.Secret.from_name("convex-url"),          # Convex database URL
     ],
-    timeout=1800  # 30 minute timeout
+    timeout=1800,          # 30 minute timeout
+    scaledown_window=300,  # Keep idle containers warm for 5 minutes
+    min_containers=1,      # Always have one warm container ready
+    max_containers=50      # Cap fan-out so a burst of prompts can't stampede Convex/GitHub
 )
-async def run_coding_agent(repo_url: str, prompt: str, session_id: str):
-    """
-    Run Claude Code using the OFFICIAL Claude Code Python SDK
-    """
+# Runs are I/O-bound and fully isolated (own temp clone, log queue, git env), so one container serves several
+@modal.concurrent(max_inputs=10)
+class Agent:
+    # Container-wide HTTP session, created lazily on the serving event loop
+    http = None
     
-    def log_to_convex(log_type: str, message: str):
-        """Log events back to Convex for real-time observability"""
-        try:
-            convex_url = os.environ["CONVEX_URL"]
-            response = requests.post(f"{convex_url}/api/mutation", 
-                json={
-                    "path": "logs:add",
-                    "args": {
-                        "type": log_type,
-                        "message": message,
-                        "sessionId": session_id
-                    }
-                },
-                headers={"Content-Type": "application/json"}
+    @modal.enter()
+    def setup(self):
+        """One-time container setup, shared by every call the warm container serves"""
+        # Modal injects secrets as env vars once per container, so read them here instead of per call
+        # (ANTHROPIC_API_KEY is picked up from the env by Claude Code, git identity is baked into the image)
+        self.convex_url = os.environ["CONVEX_URL"]
+        # Take the token out of the process env so the Claude Code CLI and its Bash tool never inherit it;
+        # git and the PR call get it explicitly from here
+        self.github_token = os.environ.pop("GITHUB_TOKEN")
+        self.git_env = _github_auth_env(self.github_token)
+    
+    @modal.exit()
+    async def teardown(self):
+        """Close the shared HTTP session when the container shuts down"""
+        if self.http is not None:
+            await self.http.close()
+    
+    def _session(self):
+        """Keep-alive session reused by every call, so warm calls skip the TLS handshakes"""
+        if self.http is None or self.http.closed:
+            self.http = aiohttp.ClientSession(
+                headers={"Content-Type": "application/json"},
+                connector=aiohttp.TCPConnector(limit=32, keepalive_timeout=60)  # Shared by concurrent runs
             )
-            print(f"[{log_type}] {message} (Convex: {response.status_code})")
-        except Exception as e:
-            print(f"[{log_type}] {message} (Convex failed: {e})")
+        return self.http
     
-    try:
-        # Import the official Claude Code SDK
-        from claude_code_sdk import query, ClaudeCodeOptions
-        from pathlib import Path
+    @modal.method()
+    async def run(self, repo_url: str, prompt: str, session_id: str):
+        """
+        Run Claude Code using the OFFICIAL Claude Code Python SDK
+        """
         
-        # STEP 1: Setup environment
-        log_to_convex("setup", "Setting up Claude Code SDK environment...")
+        log_queue = asyncio.Queue()
         
-        # Set API key for Claude Code SDK
-        os.environ["ANTHROPIC_API_KEY"] = os.environ["ANTHROPIC_API_KEY"]
+        def log_to_convex(log_type: str, message: str):
+            """Queue an event for Convex; the background flusher ships it in a batch"""
+            print(f"[{log_type}] {message}")
+            log_queue.put_nowait({
+                "type": log_type,
+                "message": message,
+                "sessionId": session_id,
+                "timestamp": time.time() * 1000
+            })
         
-        # Setup GitHub authentication
-        github_token = os.environ["GITHUB_TOKEN"]
-        subprocess.run(["gh", "auth", "login", "--with-token"], 
-                      input=github_token, text=True, check=False)
+        # Flusher task for the whole run, so logs never block the agent
+        http = self._session()
+        flusher = asyncio.create_task(_flush_logs(log_queue, http, self.convex_url))
+        try:
+            return await _run_agent(
+                repo_url, prompt, session_id, log_to_convex, http, self.github_token, self.git_env
+            )
+        finally:
+            # Make sure every queued log reaches Convex before the call returns
+            await log_queue.join()
+            flusher.cancel()
+
+async def _run_agent(repo_url: str, prompt: str, session_id: str, log_to_convex, http,
+                     github_token: str, git_env: dict):
+    """
+    Clone, run Claude Code, commit and open a PR (logs go through log_to_convex, GitHub calls through http)
+    """
+    
+    try:
+        # Official Claude Code SDK and pygit2 are imported at module load; report it here if one was missing
+        for import_error in (_SDK_IMPORT_ERROR, _PYGIT2_IMPORT_ERROR):
+            if import_error:
+                raise import_error
         
-        # Configure git with proper credentials
-        subprocess.run(["git", "config", "--global", "user.email", "claude-code@backspace.run"], check=False)
-        subprocess.run(["git", "config", "--global", "user.name", "Claude Code SDK Agent"], check=False)
-        subprocess.run(["git", "config", "--global", "credential.helper", "store"], check=False)
+        # libgit2 calls are blocking, so they run in the default executor
+        loop = asyncio.get_running_loop()
         
+        # STEP 1: Setup environment (git config is baked into the image)
+        log_to_convex("setup", "Setting up Claude Code SDK environment...")
         log_to_convex("auth_complete", "Authentication setup completed")
         
         # STEP 2: Clone repository
         log_to_convex("git_clone", f"Cloning repository: {repo_url}")
         
-        with tempfile.TemporaryDirectory() as tmp_dir:
-            repo_path = f"{tmp_dir}/repo"
-            
-            # Clone the repository
-            clone_result = subprocess.run([
-                "git", "clone", repo_url, repo_path
-            ], capture_output=True, text=True)
+        # Owner/repo for the clone/push URL and the PR API call
+        repo_match = _GH.search(repo_url)
+        if not repo_match:
+            error_msg = f"Not a GitHub repository URL: {repo_url}"
+            log_to_convex("error", error_msg)
+            return {"success": False, "error": error_msg}
+        username, repo_name = repo_match.group(1), repo_match.group(2)
+        https_url = f"https://github.com/{username}/{repo_name}.git"
+        
+        tmp_dir = None
+        try:
+            # Clone into tmpfs when it has headroom; fall back to the regular temp dir if it is short on space,
+            # unusable or the clone fills it
+            for tmp_root in ([TMP_ROOT, None] if TMP_ROOT else [None]):
+                if tmp_dir:
+                    await loop.run_in_executor(None, shutil.rmtree, tmp_dir, True)
+                try:
+                    if tmp_root is not None and shutil.disk_usage(tmp_root).free < TMP_ROOT_MIN_FREE:
+                        continue
+                    tmp_dir = tempfile.mkdtemp(dir=tmp_root)
+                except OSError:
+                    if tmp_root is None:
+                        raise
+                    continue
+                repo_path = f"{tmp_dir}/repo"
+                
+                # Shallow, blob-less clone: Claude only needs the working tree of the default branch
+                clone_code, _, clone_err = await sh(
+                    "git", "clone", "--depth=1", "--single-branch", "--filter=blob:none",
+                    https_url, repo_path, quiet=True, env=git_env
+                )
+                if clone_code == 0 or "No space left on device" not in clone_err:
+                    break
             
-            if clone_result.returncode != 0:
-                error_msg = f"Failed to clone repository: {clone_result.stderr}"
+            if clone_code != 0:
+                error_msg = f"Failed to clone repository: {clone_err}"
                 log_to_convex("error", error_msg)
                 return {"success": False, "error": error_msg}
             
-            # Change to repository directory
-            os.chdir(repo_path)
-            
-            # Configure git remote for token authentication
-            repo_name = repo_url.split('/')[-1].replace('.git', '')
-            username = repo_url.split('/')[-2]
-            token_url = f"https://{github_token}@github.com/{username}/{repo_name}.git"
-            subprocess.run(["git", "remote", "set-url", "origin", token_url], check=False)
-            
-            log_to_convex("repo_ready", "Repository cloned and configured")
-            
             # STEP 3: Create branch for changes
-            branch_name = f"claude-code/{prompt.lower().replace(' ', '-').replace('.', '').replace('/', '-')[:50]}"
-            subprocess.run(["git", "checkout", "-b", branch_name], check=False)
+            # The single-branch clone checked out the default branch, so it becomes the PR base
+            slug = _SLUG_RE.sub("-", prompt.lower()).strip("-")[:50].rstrip("-")
+            # Session suffix keeps branches unique across runs whose prompts slug the same (or to nothing, e.g. CJK)
+            branch_name = f"claude-code/{slug or 'changes'}-{session_id[-6:]}"
+            base_branch = await loop.run_in_executor(None, _prepare_branch, repo_path, branch_name)
+            log_to_convex("repo_ready", "Repository cloned and configured")
             log_to_convex("branch_created", f"Created branch: {branch_name}")
             
             # STEP 4: Configure Claude Code SDK options
@@ -130,9 +485,23 @@ async def run_coding_agent(repo_url: str, prompt: str, session_id: str):
             # STEP 5: Execute coding task using Claude Code SDK
             log_to_convex("claude_start", f"Starting Claude Code SDK: {prompt}")
             
-            # Collect all messages from Claude Code
-            messages = []
-            total_cost = 0.0
+            # Only keep counters and the final result, not the whole message stream
+            message_count = 0
+            recent = collections.deque(maxlen=8)  # Last few message classes, for error reports
+            state = {
+                "total_cost": 0.0,
+                "result_text": None,
+                "last_text": None,
+                "pending_writes": set(),
+                "stage_needed": asyncio.Event()
+            }
+            
+            # Stage files while Claude is still thinking instead of after the stream ends
+            stage_finished = asyncio.Event()
+            stage_index = f"{tmp_dir}/stage.index"  # Beside the work tree, so Claude's `git status` never lists it
+            stager = asyncio.create_task(_stage_writes(
+                state["stage_needed"], stage_finished, repo_path, stage_index, log_to_convex
+            ))
             
             try:
                 # Use the official Claude Code SDK query function
@@ -140,116 +509,134 @@ async def run_coding_agent(repo_url: str, prompt: str, session_id: str):
                     prompt=prompt,
                     options=options
                 ):
-                    messages.append(message)
+                    message_count += 1
+                    recent.append(type(message))
                     
                     # Handle different Claude Code SDK message types
-                    if hasattr(message, '__class__'):
-                        class_name = message.__class__.__name__
-                        
-                        if class_name == "SystemMessage":
-                            if hasattr(message, 'data') and message.data.get('subtype') == 'init':
-                                tools = message.data.get('tools', [])
-                                log_to_convex("claude_init", f"Claude Code initialized with {len(tools)} tools")
-                        
-                        elif class_name == "AssistantMessage":
-                            if hasattr(message, 'content'):
-                                for content_block in message.content:
-                                    if hasattr(content_block, '__class__'):
-                                        if content_block.__class__.__name__ == "TextBlock":
-                                            text = getattr(content_block, 'text', '')
-                                            log_to_convex("claude_response", f"Claude: {text[:100]}")
-                                        
-                                        elif content_block.__class__.__name__ == "ToolUseBlock":
-                                            tool_name = getattr(content_block, 'name', 'unknown')
-                                            log_to_convex("claude_tool", f"Tool: {tool_name}")
-                        
-                        elif class_name == "ResultMessage":
-                            if hasattr(message, 'num_turns'):
-                                log_to_convex("claude_result", f"Completed with {message.num_turns} turns")
-                            if hasattr(message, 'total_cost_usd'):
-                                total_cost = message.total_cost_usd
-                                log_to_convex("claude_cost", f"Cost: ${total_cost:.4f}")
+                    handler = MESSAGE_HANDLERS.get(_dispatch_key(message))
+                    if handler:
+                        handler(message, log_to_convex, state)
                 
-                log_to_convex("claude_success", f"Claude Code SDK completed with {len(messages)} messages")
-                claude_output = "Claude Code completed successfully"
+                log_to_convex("claude_success", f"Claude Code SDK completed with {message_count} messages")
+                claude_output = state["result_text"] or state["last_text"] or "Claude Code completed successfully"
                 
             except Exception as claude_error:
-                log_to_convex("claude_error", f"Claude Code SDK error: {str(claude_error)}")
+                log_to_convex("claude_error", f"Claude Code SDK error: {str(claude_error)} (after {message_count} messages, last: {', '.join(t.__name__ for t in recent)})")
                 claude_output = f"Error: {str(claude_error)}"
             
+            # Let an in-flight staging pass finish rather than cancelling it and leaving a lock behind
+            stage_finished.set()
+            state["stage_needed"].set()
+            await stager
+            # The final add -A below re-stages the whole tree, so swapping the index loses nothing Claude staged
+            await loop.run_in_executor(None, _apply_staged_index, repo_path, stage_index)
+            
+            total_cost = state["total_cost"]
+            
             # STEP 6: Check for changes and commit
             log_to_convex("git_check", "Checking for changes...")
             
-            git_status = subprocess.run(["git", "status", "--porcelain"], 
-                                      capture_output=True, text=True)
+            # Stage everything and read back one line per changed path
+            status_lines = await loop.run_in_executor(None, _stage_all, repo_path)
+            changed_count = len(status_lines)
             
-            if git_status.stdout.strip():
-                log_to_convex("changes_found", f"Found changes: {len(git_status.stdout.strip().split())} files")
-                
-                subprocess.run(["git", "add", "-A"], check=False)
+            # Cap the file list so commit and PR stay bounded no matter how big the change is
+            files_block = "\n".join(status_lines[:PR_MAX_FILES])
+            if changed_count > PR_MAX_FILES:
+                files_block += f"\n...and {changed_count - PR_MAX_FILES} more"
+            
+            if status_lines:
+                log_to_convex("changes_found", f"Found changes: {changed_count} files")
                 
                 commit_message = f"""Implement: {prompt}
 
 Implemented by Claude Code SDK
 Session: {session_id}
-Messages: {len(messages)}
+Messages: {message_count}
 Cost: ${total_cost:.4f}
 
-Summary: {claude_output}"""
-                
-                commit_result = subprocess.run([
-                    "git", "commit", "-m", commit_message
-                ], capture_output=True, text=True, check=False)
+Summary: {claude_output}
+
+Files:
+{files_block}"""
                 
-                if commit_result.returncode == 0:
+                try:
+                    await loop.run_in_executor(None, _commit, repo_path, commit_message)
                     log_to_convex("git_committed", "Successfully committed changes")
-                else:
-                    log_to_convex("git_commit_failed", f"Commit failed: {commit_result.stderr}")
+                except pygit2.GitError as commit_error:
+                    log_to_convex("git_commit_failed", f"Commit failed: {commit_error}")
                     
             else:
                 log_to_convex("no_changes", "No changes detected from Claude Code")
-                subprocess.run([
-                    "git", "commit", "--allow-empty", "-m",
-                    f"Claude Code SDK session: {prompt}\n\nSession: {session_id}"
-                ], check=False)
+                try:
+                    await loop.run_in_executor(
+                        None, _commit, repo_path,
+                        f"Claude Code SDK session: {prompt}\n\nSession: {session_id}"
+                    )
+                except pygit2.GitError as commit_error:
+                    log_to_convex("git_commit_failed", f"Commit failed: {commit_error}")
             
             # STEP 7: Push and create PR
             log_to_convex("pr_start", "Creating pull request...")
             
-            push_result = subprocess.run([
-                "git", "push", "origin", branch_name
-            ], capture_output=True, text=True, check=False)
+            push_task = asyncio.create_task(_with_github_slot(sh(
+                "git", "push", https_url,
+                f"HEAD:refs/heads/{branch_name}", cwd=repo_path, quiet=True, env=git_env
+            )))
+            # One loop turn lets the task spawn git, then the PR is prepared while the push is on the wire
+            await asyncio.sleep(0)
+            
+            pr_title = f"Claude Code SDK: {prompt}"
+            
+            pr_body = "\n".join([
+                "## Implementation by Claude Code SDK",
+                "",
+                f"**Task**: {prompt}",
+                "",
+                "**Implementation Summary**:",
+                claude_output,
+                "",
+                "**Files Changed**:",
+                "```",
+                files_block or "(none)",
+                "```",
+                "",
+                "**Technical Details**:",
+                "- **Agent**: Claude Code SDK (Official Anthropic Python SDK)",
+                f"- **Session ID**: {session_id}",
+                f"- **Branch**: {branch_name}",
+                f"- **Messages Processed**: {message_count}",
+                f"- **Total Cost**: ${total_cost:.4f} USD",
+                "",
+                "Generated automatically by Tiny Backspace coding agent.",
+                ""
+            ])
             
-            if push_result.returncode == 0:
+            push_code, _, push_err = await push_task
+            
+            if push_code == 0:
                 log_to_convex("push_success", f"Successfully pushed branch: {branch_name}")
                 
-                pr_title = f"Claude Code SDK: {prompt}"
-                pr_body = f"""## Implementation by Claude Code SDK
-
-**Task**: {prompt}
-
-**Implementation Summary**:
-{claude_output}
-
-**Technical Details**:
-- **Agent**: Claude Code SDK (Official Anthropic Python SDK)
-- **Session ID**: {session_id}
-- **Branch**: {branch_name}
-- **Messages Processed**: {len(messages)}
-- **Total Cost**: ${total_cost:.4f} USD
-
-Generated automatically by Tiny Backspace coding agent.
-"""
-                
-                pr_result = subprocess.run([
-                    "gh", "pr", "create",
-                    "--title", pr_title,
-                    "--body", pr_body,
-                    "--base", "main"
-                ], capture_output=True, text=True, check=False)
+                # Single REST call over the pooled session instead of forking the gh CLI
+                async with _GITHUB_SEM, http.post(
+                    f"https://api.github.com/repos/{username}/{repo_name}/pulls",
+                    json={
+                        "title": pr_title,
+                        "body": pr_body,
+                        "head": branch_name,
+                        "base": base_branch
+                    },
+                    headers={
+                        "Authorization": f"Bearer {github_token}",
+                        "Accept": "application/vnd.github+json",
+                        "X-GitHub-Api-Version": GITHUB_API_VERSION
+                    }
+                ) as pr_response:
+                    # Error pages (502/503) can be HTML, so only the 201 body is parsed as JSON
+                    pr_text = await pr_response.text()
                 
-                if pr_result.returncode == 0:
-                    pr_url = pr_result.stdout.strip()
+                if pr_response.status == 201:
+                    pr_url = json.loads(pr_text)["html_url"]
                     log_to_convex("success", f"Successfully created PR: {pr_url}")
                     
                     return {
@@ -260,16 +647,20 @@ Generated automatically by Tiny Backspace coding agent.
                         "summary": claude_output
                     }
                 else:
-                    error_msg = f"Failed to create PR: {pr_result.stderr}"
+                    error_msg = f"Failed to create PR: {pr_response.status} {pr_text[:500]}"
                     log_to_convex("pr_failed", error_msg)
                     return {"success": False, "error": error_msg}
             else:
-                error_msg = f"Failed to push branch: {push_result.stderr}"
+                error_msg = f"Failed to push branch: {push_err}"
                 log_to_convex("push_failed", error_msg)
                 return {"success": False, "error": error_msg}
+        finally:
+            # Remove the clone in a worker thread so a large tree doesn't stall the event loop
+            if tmp_dir:
+                await loop.run_in_executor(None, shutil.rmtree, tmp_dir, True)
     
     except ImportError as import_error:
-        error_msg = f"Claude Code SDK not available: {str(import_error)}"
+        error_msg = f"Claude Code SDK dependencies not available: {str(import_error)}"
         log_to_convex("sdk_missing", error_msg)
         return {"success": False, "error": error_msg}
     
@@ -0,0 +1,25 @@
+import argparse
+import modal
+
+# Must match the app name and class deployed by `modal deploy modal/agent.py`
+APP_NAME = "tiny-backspace-v2"
+
+def main():
+    """Queue one run on the deployed Agent class and print the call id
+
+    Unlike `modal run`, this reuses the deployed app, so warm containers, the enter hook
+    and the shared HTTP session serve every request.
+    """
+    parser = argparse.ArgumentParser(description="Dispatch a coding task to the deployed Modal agent")
+    parser.add_argument("--repo-url", required=True)
+    parser.add_argument("--prompt", required=True)
+    parser.add_argument("--session-id", required=True)
+    args = parser.parse_args()
+
+    Agent = modal.Cls.from_name(APP_NAME, "Agent")
+    # spawn returns as soon as the input is queued; the run itself continues on Modal
+    call = Agent().run.spawn(args.repo_url, args.prompt, args.session_id)
+    print(call.object_id)
+
+if __name__ == "__main__":
+    main()
@@ -13,35 +13,37 @@ export async function POST(req: NextRequest) {
     
     const sessionId = `session_${Date.now()}_${Math.random().toString(36).substring(7)}`;
     
-    // Log that we're starting a new coding session
-    await convex.mutation(api.logs.add, {
+    // Log that we're starting a new coding session (sent together with the trigger result below)
+    const startLog = {
       type: "api_start",
       message: `Starting Claude Code session for ${repoUrl}`,
-      sessionId: sessionId
-    });
+      sessionId: sessionId,
+      timestamp: Date.now()
+    };
     
-    // FULL INTEGRATION: Automatically trigger Modal agent
-    const { spawn } = require('child_process');
+    // FULL INTEGRATION: Queue a run on the deployed Modal agent (warm containers, no per-request app)
+    const { execFile } = require('child_process');
+    const { promisify } = require('util');
     
     try {
-      const modalProcess = spawn('modal', [
-        'run', 
-        'modal/agent.py::run_coding_agent',
+      // The dispatcher returns as soon as Modal accepts the call, the agent keeps running there
+      // MODAL_PYTHON points at an interpreter with `modal` installed (e.g. the venv/pipx env of the modal CLI)
+      const { stdout } = await promisify(execFile)(process.env.MODAL_PYTHON || 'python3', [
+        'modal/dispatch.py',
         '--repo-url', repoUrl,
         '--prompt', prompt,
         '--session-id', sessionId
-      ], {
-        detached: true,    
-        stdio: 'ignore'   
-      });
-      
-      // Don't wait for Modal to complete, just trigger it
-      modalProcess.unref();
+      ], { timeout: 30000 });
+      const callId = stdout.trim();
       
-      await convex.mutation(api.logs.add, {
-        type: "modal_triggered",
-        message: "Modal Claude Code agent triggered automatically",
-        sessionId: sessionId
+      // One Convex round-trip for both events
+      await convex.mutation(api.logs.addBatch, {
+        logs: [startLog, {
+          type: "modal_triggered",
+          message: `Modal Claude Code agent triggered automatically (call ${callId})`,
+          sessionId: sessionId,
+          timestamp: Date.now()
+        }]
       });
       
       // Return immediately while Modal works in background
@@ -54,17 +56,20 @@ export async function POST(req: NextRequest) {
       });
       
     } catch (modalError: any) {
-      await convex.mutation(api.logs.add, {
-        type: "modal_error",
-        message: `Failed to start Modal agent: ${modalError?.message || 'Unknown error'}`,
-        sessionId: sessionId
+      await convex.mutation(api.logs.addBatch, {
+        logs: [startLog, {
+          type: "modal_error",
+          message: `Failed to start Modal agent: ${modalError?.message || 'Unknown error'}`,
+          sessionId: sessionId,
+          timestamp: Date.now()
+        }]
       });
       
       return NextResponse.json({
         success: false,
         sessionId: sessionId,
         error: "Failed to start Claude Code agent",
-        message: "Please check that Modal is installed and configured"
+        message: "Please check that Modal is installed, configured and the agent is deployed"
       }, { status: 500 });
     }
     